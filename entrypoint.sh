@@ -1,6 +1,9 @@
 #!/bin/bash
+# Number of API workers, also read by the API to split the rate limits
+export API_WORKERS="${API_WORKERS:-4}"
+
 # Starts the API in the background
-uvicorn src.api.llm_api:app --reload --host 0.0.0.0 --port 8000 &
+uvicorn src.api.llm_api:app --workers "$API_WORKERS" --host 0.0.0.0 --port 8000 &
 
 # Starts the chainlit
 chainlit run src/webapp.py --port 8001
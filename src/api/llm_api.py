@@ -1,8 +1,17 @@
+import os
+import uuid
+from typing import Optional
+
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
-from src.llm.create_rag_db import update_chroma_db
-from src.llm.llm_model import StudyJourney
+from src.llm.create_rag_db import load_vector_db
+from src.llm.deadline import Deadline, request_budget
+from src.llm.lesson_snippets import load_snippet_index
+from src.llm.llm_model import ConversationComponents, StudyJourney
+from src.llm.request_coalescing import RequestCoalescer
+from src.llm.session_store import DEFAULT_SESSION_STORE_URL, create_session_store
+from src.llm.upstream_scheduler import SchedulerOverloaded, UpstreamScheduler
 
 description = """
 StudyJourney API
@@ -24,12 +33,22 @@ Accepts questions, returns tailored responses and relevant document excerpts.
 - URL: `/query`
 - Body (JSON):
   - `question` (str): The user's question.
+  - `session_id` (str, optional): Identifier of the conversation. A new one
+    is created when omitted.
 
 #### Response
 
 - Status: `200 OK`
 - Body (JSON):
   - `message` (str): The response message from the assistant.
+  - `session_id` (str): Identifier to send with the next questions.
+- Status: `503 Service Unavailable` when the upstream queue is saturated,
+  with a `Retry-After` header.
+
+Each request has a budget of `REQUEST_DEADLINE_SECONDS` (18 s by default).
+As it runs out, the last known conversation state is kept, document retrieval
+is skipped and the answer comes from recent answers or precomputed lesson
+snippets, instead of timing out.
 
 #### Example
 
@@ -37,26 +56,58 @@ Accepts questions, returns tailored responses and relevant document excerpts.
 curl -X POST "http://localhost:8000/query" -H "Content-Type: application/json"
 -d '{"question": "Como posso aprender fundamentos de programação?",
 "stage": "main"}'
+```
+
+### `GET /metrics`
+
+Returns, for each upstream model, the queue depth by priority, the number of
+admitted and shed calls, and the requests and tokens currently available.
 """
 
 app = FastAPI(title="StudyJourney API", description=description, version="1.0.0")
 
-retriever = update_chroma_db()
-study_journey = StudyJourney(retriever=retriever)
+scheduler = UpstreamScheduler.from_env()
+components = ConversationComponents(
+    retriever=load_vector_db(),
+    session_store=create_session_store(
+        os.getenv("SESSION_STORE_URL", DEFAULT_SESSION_STORE_URL)
+    ),
+    coalescer=RequestCoalescer(
+        hedge=os.getenv("LLM_HEDGING", "false").lower() == "true"
+    ),
+    snippet_index=load_snippet_index(),
+    scheduler=scheduler,
+)
 
 
 class QueryRequest(BaseModel):
     question: str
+    session_id: Optional[str] = None
 
 
 class QueryResponse(BaseModel):
     message: str
+    session_id: str
 
 
 @app.post("/query", response_model=QueryResponse)
 def query_model(request: QueryRequest):
+    deadline = Deadline(request_budget())
+    session_id = request.session_id or str(uuid.uuid4())
     try:
-        message = study_journey.get_answer(question=request.question)
-        return QueryResponse(message=message["text"])
+        study_journey = StudyJourney(components, session_id=session_id)
+        message = study_journey.get_answer(question=request.question, deadline=deadline)
+        return QueryResponse(message=message["text"], session_id=session_id)
+    except SchedulerOverloaded as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/metrics")
+def metrics():
+    return {"upstream": scheduler.metrics()}
@@ -1,15 +1,81 @@
+import os
+from pathlib import Path
+
 from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain_community.vectorstores import Chroma
+from langchain_core.vectorstores import VectorStoreRetriever
+
+from src.llm.upstream_scheduler import CLIENT_MAX_RETRIES
+from src.llm.vector_store import (
+    MANIFEST_FILE,
+    CompactVectorStore,
+    file_lock,
+    index_settings_from_env,
+)
+
+CHROMA_DB_DIR = "data/03_primary/chroma_db"
+COMPACT_INDEX_DIR = "data/03_primary/compact_index"
 
 
 def update_chroma_db() -> Chroma:
-    chroma_db_dir = "data/03_primary/chroma_db"
     docsearch = Chroma(
-        persist_directory=chroma_db_dir,
-        embedding_function=OpenAIEmbeddings(model="text-embedding-ada-002"),
+        persist_directory=CHROMA_DB_DIR,
+        embedding_function=OpenAIEmbeddings(
+            model="text-embedding-ada-002", max_retries=CLIENT_MAX_RETRIES
+        ),
     )
 
     docsearch.persist()
     retriever = docsearch.as_retriever()
 
     return retriever
+
+
+def load_compact_db() -> VectorStoreRetriever:
+    """
+    Open the memory-mapped compact index, exporting it from Chroma on first use.
+
+    The export runs under a file lock, so when several uvicorn workers start
+    without an index only the first one builds it and the others open it.
+
+    The storage type and the number of IVF lists used for the export come
+    from `index_settings_from_env`.
+
+    Returns
+    -------
+    VectorStoreRetriever
+        A retriever with the same interface as the Chroma one.
+    """
+    embedding = OpenAIEmbeddings(
+        model="text-embedding-ada-002", max_retries=CLIENT_MAX_RETRIES
+    )
+    index_dir = Path(COMPACT_INDEX_DIR)
+    index_dir.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(index_dir.with_name(f".{index_dir.name}.export.lock")):
+        if not (index_dir / MANIFEST_FILE).exists():
+            docsearch = Chroma(
+                persist_directory=CHROMA_DB_DIR, embedding_function=embedding
+            )
+            CompactVectorStore.from_chroma(
+                docsearch, COMPACT_INDEX_DIR, **index_settings_from_env()
+            )
+
+    docsearch = CompactVectorStore(COMPACT_INDEX_DIR, embedding)
+    return docsearch.as_retriever()
+
+
+def load_vector_db() -> VectorStoreRetriever:
+    """
+    Load the retriever selected by the `VECTOR_STORE_BACKEND` environment variable.
+
+    Returns
+    -------
+    VectorStoreRetriever
+        The Chroma retriever ("chroma", default) or the compact one ("compact").
+    """
+    backend = os.getenv("VECTOR_STORE_BACKEND", "chroma")
+    if backend == "compact":
+        return load_compact_db()
+    if backend == "chroma":
+        return update_chroma_db()
+    raise ValueError(f"VECTOR_STORE_BACKEND desconhecido: {backend}")
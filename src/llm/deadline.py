@@ -0,0 +1,125 @@
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Optional
+
+DEFAULT_REQUEST_DEADLINE = 18.0
+
+# FastAPI runs the synchronous endpoints in a pool of 40 threads per worker.
+SERVER_THREADS = 40
+
+# Runs the upstream stages so the request thread can stop waiting for them.
+# Each request runs one stage at a time, and a stage it abandoned keeps a
+# worker until its upstream timeout (the time that was left) expires, hence
+# two workers per server thread. Beyond that, stages wait in the queue and
+# requests degrade as their deadline passes (`DEADLINE_STAGE_WORKERS`).
+STAGE_WORKERS = int(os.getenv("DEADLINE_STAGE_WORKERS", 2 * SERVER_THREADS))
+_executor = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="deadline")
+
+
+def request_budget() -> float:
+    """Seconds granted to each `/query` request (`REQUEST_DEADLINE_SECONDS`)."""
+    return float(os.getenv("REQUEST_DEADLINE_SECONDS", DEFAULT_REQUEST_DEADLINE))
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a stage cannot finish inside the request budget."""
+
+
+class Deadline:
+    """
+    Time budget of a request, started by the API handler and passed through
+    every stage (state, retrieval, generation).
+
+    Attributes:
+        budget (float): Total number of seconds granted to the request.
+        expires_at (float): `time.monotonic()` value at which the budget ends.
+    """
+
+    def __init__(self, budget: float = math.inf):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    @property
+    def bounded(self) -> bool:
+        return math.isfinite(self.budget)
+
+    def remaining(self) -> float:
+        """Seconds left in the budget, never negative."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def cap(self, seconds: float) -> float:
+        """Limit a timeout to the time left in the budget."""
+        return min(seconds, self.remaining())
+
+    def allows(self, seconds: float) -> bool:
+        """Whether at least `seconds` are left in the budget."""
+        return self.remaining() >= seconds
+
+    def stage(self, reserve: float) -> "Deadline":
+        """
+        Deadline of a stage that must end `reserve` seconds before this one.
+
+        Passed to the upstream calls of a stage run with the same `reserve`,
+        so their scheduler queue wait and timeout end when the stage is given
+        up rather than when the request is.
+        """
+        stage = Deadline(self.budget)
+        stage.expires_at = self.expires_at - reserve
+        return stage
+
+    def run(self, fn: Callable[[], Any], reserve: float = 0.0) -> Any:
+        """
+        Run a stage, giving up when only `reserve` seconds are left.
+
+        The stage runs in a worker thread; when the budget runs out it is
+        cancelled if it has not started, otherwise it is abandoned and its
+        result ignored. Upstream calls should also receive the time left in
+        `stage(reserve)` as their own timeout so abandoned calls stop soon
+        after.
+
+        Parameters
+        ----------
+        fn : Callable[[], Any]
+            The stage to run.
+        reserve : float, optional
+            Seconds kept for the following stages, by default 0.0.
+
+        Returns
+        -------
+        Any
+            The result of the stage.
+
+        Raises
+        ------
+        DeadlineExceeded
+            When the stage did not finish in time.
+        """
+        if not self.bounded:
+            return fn()
+
+        timeout = self.remaining() - reserve
+        if timeout <= 0:
+            raise DeadlineExceeded()
+        future = _executor.submit(fn)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeoutError as e:
+            future.cancel()
+            raise DeadlineExceeded() from e
+
+
+def timeout_for(deadline: Optional[Deadline]) -> Optional[float]:
+    """Timeout to pass to an upstream client, or None when unbounded."""
+    if deadline is None or not deadline.bounded:
+        return None
+    return max(deadline.remaining(), 0.1)
+
+
+def queue_wait_for(deadline: Optional[Deadline], max_queue_wait: float) -> float:
+    """Longest time a call may wait in the upstream scheduler queue."""
+    if deadline is None:
+        return max_queue_wait
+    return deadline.cap(max_queue_wait)
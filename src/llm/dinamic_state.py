@@ -1,16 +1,99 @@
-from typing import List
+import threading
+from typing import List, Optional, Tuple
 
+import httpx
 from autogen.agentchat.contrib.retrieve_assistant_agent import RetrieveAssistantAgent
 from autogen.agentchat.contrib.retrieve_user_proxy_agent import UserProxyAgent
+from autogen.oai import OpenAIWrapper
 from langchain.docstore.document import Document as LangchainDocument
+from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.memory import ChatMessageHistory
 from langchain.prompts import PromptTemplate
 from langchain_community.vectorstores import Chroma
 
+from src.llm.deadline import Deadline, queue_wait_for, timeout_for
+from src.llm.request_coalescing import RequestCoalescer, make_key
+from src.llm.session_store import SessionState
+from src.llm.upstream_scheduler import (
+    CLIENT_MAX_RETRIES,
+    UpstreamScheduler,
+    estimate_tokens,
+)
+
+CONVERSATION_PROMPTS = {
+    "intro": PromptTemplate(
+        template="""
+                Você é um assistente de aprendizado interativo da +A Educação. Seu objetivo é
+                ajudar os usuários a se familiarizarem com o sistema e entenderem como você
+                pode ajudá-los.
+
+                Se o usuário disser "oi" ou perguntar "o que você pode fazer?", responda de
+                maneira acolhedora explicando suas funcionalidades:
+                1. Avaliar dificuldades de conhecimento.
+                2. Perguntar sobre preferências de aprendizado.
+                3. Fornecer sugestões de conteúdos adaptados.
+
+                Aqui está a questão do usuário: {question}
+                """,
+        input_variables=["question"],
+    ),
+    "main": PromptTemplate(
+        template="""
+                    Você é um assistente de aprendizado interativo da +A Educação. Seu objetivo é
+                    ajudar os usuários a identificar suas dificuldades e lacunas de conhecimento em
+                    um tema específico e fornecer conteúdos adaptados ao seu nível de conhecimento
+                    e formato de preferência.
+
+                    Durante o diálogo, você deve:
+                    1. Avaliar e entender as áreas onde o conhecimento do usuário pode ser insuficiente.
+                    2. Perguntar sobre as preferências de aprendizado do usuário (texto, vídeo, áudio).
+                    3. Fornecer respostas e sugestões de conteúdos adaptados às preferências e
+                    necessidades do usuário, usando exatamente o que estiver em: \n\n {document} \n\n.
+
+                    Aqui está a questão do usuário: {question}
+
+                    Responda de maneira clara e direta com base nas informações fornecidas e adapte suas
+                    respostas conforme as preferências de aprendizado do usuário.
+                    Caso não tenha a informação, informe que não possui informação sobre o tema e
+                    sugira uma nova pergunta ao usuário.
+                    """,
+        input_variables=["question", "document"],
+    ),
+    "end": PromptTemplate(
+        template="""
+        Você é um assistente de aprendizado interativo da +A Educação. Seu objetivo é
+        garantir que o usuário não tenha mais dúvidas pendentes e se despedir de maneira cordial.
+
+        Pergunte ao usuário se ele tem mais alguma dúvida. Se não, agradeça pela interação
+        e deseje ótimos estudos, caso o usuário agradeça também o agradeça.
+
+        Aqui está a questão do usuário: {question}
+        """,
+        input_variables=["question"],
+    ),
+}
+
 
 class ContentRetrievalManager:
-    def __init__(self, retriever: Chroma):
+    """
+    Embeds the questions and retrieves their documents.
+
+    Embeddings made under a request deadline use a client whose timeout is
+    the time left in the request and which does not retry, like the
+    completions (see `StateController`).
+    """
+
+    def __init__(
+        self,
+        retriever: Chroma,
+        coalescer: Optional[RequestCoalescer] = None,
+        scheduler: Optional[UpstreamScheduler] = None,
+    ):
         self.retriever = retriever
+        self.coalescer = coalescer
+        self.scheduler = scheduler
+        # Connection pool shared by the per-call embedding clients.
+        self._http_client = httpx.Client()
 
     def format_docs(self, docs: List[LangchainDocument]) -> str:
         """
@@ -51,7 +134,58 @@ class ContentRetrievalManager:
             )
         return formatted_docs
 
-    def get_product_details(self, query: str) -> str:
+    def embed_query(
+        self, query: str, deadline: Optional[Deadline] = None
+    ) -> List[float]:
+        """
+        Embed the query with the retriever's embedding model.
+
+        The vector is shared by the lesson snippet lookup and the retrieval,
+        so each question is embedded only once.
+
+        Parameters
+        ----------
+        query : str
+            The user's query.
+        deadline : Deadline, optional
+            Budget of the request, bounds the wait for the upstream scheduler
+            and the embedding call.
+
+        Returns
+        -------
+        List[float]
+            The query embedding.
+        """
+        if self.coalescer is None:
+            return self._embed(query, deadline)
+        return self.coalescer.call(
+            "embedding", make_key(query), lambda: self._embed(query, deadline)
+        )
+
+    def _embed(self, query: str, deadline: Optional[Deadline] = None) -> List[float]:
+        if self.scheduler is not None:
+            self.scheduler.acquire(
+                "text-embedding-ada-002",
+                estimate_tokens(query),
+                max_wait=queue_wait_for(deadline, self.scheduler.max_queue_wait),
+            )
+        embeddings = self.retriever.vectorstore.embeddings
+        timeout = timeout_for(deadline)
+        if timeout is not None:
+            embeddings = OpenAIEmbeddings(
+                model=embeddings.model,
+                request_timeout=timeout,
+                max_retries=0,
+                http_client=self._http_client,
+            )
+        return embeddings.embed_query(query)
+
+    def get_product_details(
+        self,
+        query: str,
+        embedding: Optional[List[float]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
         """
         Retrieve product details from RAG based on the query.
 
@@ -59,15 +193,44 @@ class ContentRetrievalManager:
         ----------
         query : str
             The user's query or product name to search for in the RAG.
+        embedding : List[float], optional
+            The query embedding from `embed_query`; when omitted the retriever
+            embeds the query itself.
+        deadline : Deadline, optional
+            Budget of the request, bounds the wait for the upstream scheduler.
 
         Returns
         -------
         str
             String with product details.
         """
-        retrieved_docs = self.retriever.get_relevant_documents(query)
+        if self.coalescer is None:
+            return self._retrieve(query, embedding, deadline)
+        retrieved_docs = self.coalescer.call(
+            "retrieval",
+            make_key(query),
+            lambda: self._retrieve(query, embedding, deadline),
+        )
         return retrieved_docs
 
+    def _retrieve(
+        self,
+        query: str,
+        embedding: Optional[List[float]] = None,
+        deadline: Optional[Deadline] = None,
+    ) -> List[LangchainDocument]:
+        if embedding is not None:
+            return self.retriever.vectorstore.similarity_search_by_vector(
+                embedding, **self.retriever.search_kwargs
+            )
+        if self.scheduler is not None:
+            self.scheduler.acquire(
+                "text-embedding-ada-002",
+                estimate_tokens(query),
+                max_wait=queue_wait_for(deadline, self.scheduler.max_queue_wait),
+            )
+        return self.retriever.get_relevant_documents(query)
+
 
 class ConversationCoordinator:
     """
@@ -75,8 +238,10 @@ class ConversationCoordinator:
     This chatbot assists users by providing personalized content recommendations based on their queries
     and guiding them through the various stages of the learning process.
 
+    It holds no per-session data: the current state of each conversation lives
+    in its `SessionState`, so a single instance is shared by every session.
+
     Attributes:
-        state (str): Represents the current state of the chatbot in the conversation flow.
         document_manager (ContentRetrievalManager): Manages retrieval and formatting of product
                                            details from a document database.
         prompts (dict): A dictionary mapping conversation states to their respective
@@ -84,64 +249,12 @@ class ConversationCoordinator:
                         user inputs and document data.
 
     Methods:
-        __init__: Initializes the chatbot with a document retriever.
+        __init__: Initializes the chatbot with a document manager.
     """
 
-    def __init__(self, retriever: Chroma):
-        self.state = "intro"
-        self.document_manager = ContentRetrievalManager(retriever)
-        self.prompts = {
-            "intro": PromptTemplate(
-                template="""
-                Você é um assistente de aprendizado interativo da +A Educação. Seu objetivo é
-                ajudar os usuários a se familiarizarem com o sistema e entenderem como você
-                pode ajudá-los.
-
-                Se o usuário disser "oi" ou perguntar "o que você pode fazer?", responda de
-                maneira acolhedora explicando suas funcionalidades:
-                1. Avaliar dificuldades de conhecimento.
-                2. Perguntar sobre preferências de aprendizado.
-                3. Fornecer sugestões de conteúdos adaptados.
-
-                Aqui está a questão do usuário: {question}
-                """,
-                input_variables=["question"],
-            ),
-            "main": PromptTemplate(
-                template="""
-                    Você é um assistente de aprendizado interativo da +A Educação. Seu objetivo é
-                    ajudar os usuários a identificar suas dificuldades e lacunas de conhecimento em
-                    um tema específico e fornecer conteúdos adaptados ao seu nível de conhecimento
-                    e formato de preferência.
-
-                    Durante o diálogo, você deve:
-                    1. Avaliar e entender as áreas onde o conhecimento do usuário pode ser insuficiente.
-                    2. Perguntar sobre as preferências de aprendizado do usuário (texto, vídeo, áudio).
-                    3. Fornecer respostas e sugestões de conteúdos adaptados às preferências e
-                    necessidades do usuário, usando exatamente o que estiver em: \n\n {document} \n\n.
-
-                    Aqui está a questão do usuário: {question}
-
-                    Responda de maneira clara e direta com base nas informações fornecidas e adapte suas
-                    respostas conforme as preferências de aprendizado do usuário.
-                    Caso não tenha a informação, informe que não possui informação sobre o tema e
-                    sugira uma nova pergunta ao usuário.
-                    """,
-                input_variables=["question", "document"],
-            ),
-            "end": PromptTemplate(
-                template="""
-        Você é um assistente de aprendizado interativo da +A Educação. Seu objetivo é
-        garantir que o usuário não tenha mais dúvidas pendentes e se despedir de maneira cordial.
-
-        Pergunte ao usuário se ele tem mais alguma dúvida. Se não, agradeça pela interação
-        e deseje ótimos estudos, caso o usuário agradeça também o agradeça.
-
-        Aqui está a questão do usuário: {question}
-        """,
-                input_variables=["question"],
-            ),
-        }
+    def __init__(self, document_manager: ContentRetrievalManager):
+        self.document_manager = document_manager
+        self.prompts = CONVERSATION_PROMPTS
 
 
 class StateController:
@@ -149,54 +262,120 @@ class StateController:
     Manages conversation state transitions within a marketplace environment, utilizing
     a state machine approach with an LLM to determine and update states based on user interaction.
 
+    The autogen agents keep the messages of their last chat, so each worker
+    thread lazily creates its own pair, which is then reused by every session
+    served by that thread. The visited states are read from and written to the
+    `SessionState` of the conversation.
+
+    Calls made under a request deadline get a client whose timeout is the
+    time left in the request and which does not retry, so an abandoned call
+    stops soon after the request gives up on it.
+
     Attributes:
         chatbot (ConversationCoordinator): The chatbot instance managing the conversation.
         llm (RetrieveAssistantAgent): LLM agent used to determine conversation state.
-        visited_states (List[str]): A list of states the conversation has already visited.
         user_proxy (UserProxyAgent): Proxy agent that manages communication with the LLM.
+        coalescer (RequestCoalescer, optional): Shares identical in-flight state calls.
+        scheduler (UpstreamScheduler, optional): Rate limits the state calls.
     """
 
-    def __init__(self, chatbot: ConversationCoordinator):
+    def __init__(
+        self,
+        chatbot: ConversationCoordinator,
+        coalescer: Optional[RequestCoalescer] = None,
+        scheduler: Optional[UpstreamScheduler] = None,
+    ):
         self.chatbot = chatbot
-        self.llm = RetrieveAssistantAgent(
-            name="MarketplaceStateAgent",
-            system_message="Determine the current state of the conversation based on the history provided.",
-            llm_config={
-                "timeout": 600,
-                "cache_seed": 42,
-                "config_list": [{"model": "gpt-3.5-turbo", "temperature": 0}],
-            },
-        )
-        self.visited_states = []
-        self.user_proxy = UserProxyAgent(
-            name="state_agent",
-            human_input_mode="NEVER",
-            max_consecutive_auto_reply=0,
-            is_termination_msg=lambda x: x.get("content", "")
-            .rstrip()
-            .endswith("TERMINATE")
-            or x.get("content", "").rstrip().endswith("TERMINATE."),
-            code_execution_config={
-                "use_docker": False,
-            },
-        )
-
-    def determine_state(self, history: ChatMessageHistory) -> str:
+        self.coalescer = coalescer
+        self.scheduler = scheduler
+        self._agents = threading.local()
+        # Connection pool shared by the per-call clients of every thread.
+        self._http_client = httpx.Client()
+
+    def _thread_agents(self) -> Tuple[RetrieveAssistantAgent, UserProxyAgent]:
+        if not hasattr(self._agents, "llm"):
+            self._agents.llm = RetrieveAssistantAgent(
+                name="MarketplaceStateAgent",
+                system_message="Determine the current state of the conversation based on the history provided.",
+                llm_config={
+                    "timeout": 600,
+                    "max_retries": CLIENT_MAX_RETRIES,
+                    "cache_seed": 42,
+                    "config_list": [{"model": "gpt-3.5-turbo", "temperature": 0}],
+                    "http_client": self._http_client,
+                },
+            )
+            self._agents.user_proxy = UserProxyAgent(
+                name="state_agent",
+                human_input_mode="NEVER",
+                max_consecutive_auto_reply=0,
+                is_termination_msg=lambda x: x.get("content", "")
+                .rstrip()
+                .endswith("TERMINATE")
+                or x.get("content", "").rstrip().endswith("TERMINATE."),
+                code_execution_config={
+                    "use_docker": False,
+                },
+            )
+        return self._agents.llm, self._agents.user_proxy
+
+    @property
+    def llm(self) -> RetrieveAssistantAgent:
+        return self._thread_agents()[0]
+
+    @property
+    def user_proxy(self) -> UserProxyAgent:
+        return self._thread_agents()[1]
+
+    def determine_state(
+        self,
+        history: ChatMessageHistory,
+        visited_states: List[str],
+        deadline: Optional[Deadline] = None,
+    ) -> str:
         """
         Determines the current conversation state based on the provided history.
 
         Parameters:
             history (ChatMessageHistory): The historical record of the conversation.
+            visited_states (List[str]): States the conversation has already visited.
+            deadline (Deadline, optional): Budget of the request.
 
         Returns:
             str: The predicted current state of the conversation.
         """
-        prompt = self.generate_prompt(history)
-        state_prediction = self.user_proxy.initiate_chat(self.llm, message=prompt)
+        prompt = self.generate_prompt(history, visited_states)
+        if self.coalescer is None:
+            return self._predict_state(prompt, deadline)
+        state_prediction = self.coalescer.call(
+            "state", make_key(prompt), lambda: self._predict_state(prompt, deadline)
+        )
         return state_prediction
 
-    def generate_prompt(self, history: ChatMessageHistory) -> str:
-        visited_states = ", ".join(self.visited_states)
+    def _predict_state(self, prompt: str, deadline: Optional[Deadline] = None):
+        if self.scheduler is not None:
+            self.scheduler.acquire(
+                "gpt-3.5-turbo",
+                estimate_tokens(prompt) + 16,
+                max_wait=queue_wait_for(deadline, self.scheduler.max_queue_wait),
+            )
+        llm, user_proxy = self._thread_agents()
+        timeout = timeout_for(deadline)
+        if timeout is None:
+            return user_proxy.initiate_chat(llm, message=prompt)
+        client = llm.client
+        llm.client = OpenAIWrapper(
+            **{**llm.llm_config, "timeout": timeout, "max_retries": 0}
+        )
+        try:
+            return user_proxy.initiate_chat(llm, message=prompt)
+        finally:
+            llm.client = client
+
+    def generate_prompt(
+        self, history: ChatMessageHistory, visited_states: List[str]
+    ) -> str:
+        visited_states = ", ".join(visited_states)
         prompt = f"""
         Given the conversation history:
         '{history}'
@@ -210,22 +389,36 @@ class StateController:
         """
         return prompt
 
-    def update_chatbot_state(self, history: ChatMessageHistory) -> str:
+    def update_chatbot_state(
+        self,
+        history: ChatMessageHistory,
+        session: SessionState,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
         """
-        Updates the chatbot's state based on the conversation history.
+        Updates the session's state based on the conversation history.
 
         Parameters:
             history (ChatMessageHistory): The historical record of the conversation.
+            session (SessionState): The conversation state to update.
+            deadline (Deadline, optional): Budget of the request.
 
         Returns:
-            str: The chatbot's prompt for the newly updated state.
+            str: The newly predicted state, a key of `chatbot.prompts`.
         """
-        predicted_state = self.determine_state(history)
+        predicted_state = self.determine_state(
+            history, session.visited_states, deadline
+        )
         llm_response = predicted_state.summary
-        if llm_response not in self.chatbot.state:
-            self.visited_states.append(llm_response)
-            self.chatbot.state = llm_response
-        return self.chatbot.prompts[llm_response]
-
-    def handle_input(self, history: ChatMessageHistory) -> str:
-        return self.update_chatbot_state(history)
+        if llm_response not in session.state:
+            session.visited_states.append(llm_response)
+            session.state = llm_response
+        return llm_response
+
+    def handle_input(
+        self,
+        history: ChatMessageHistory,
+        session: SessionState,
+        deadline: Optional[Deadline] = None,
+    ) -> str:
+        return self.update_chatbot_state(history, session, deadline)
@@ -0,0 +1,127 @@
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.memory import ChatMessageHistory
+
+from src.llm.vector_store import MANIFEST_FILE, CompactVectorStore
+
+SNIPPETS_DIR = "data/03_primary/lesson_snippets"
+
+SNIPPETS_PER_TOPIC = 9
+
+
+def detect_preferences(history: ChatMessageHistory) -> Tuple[str, str]:
+    """
+    Infer the learner's level and preferred format from their messages.
+
+    The most recent user message mentioning a level or a format wins; the
+    defaults are "iniciante" and "texto".
+
+    Parameters
+    ----------
+    history : ChatMessageHistory
+        The historical record of the conversation.
+
+    Returns
+    -------
+    Tuple[str, str]
+        The difficulty and the format.
+    """
+    difficulty, format_type = "iniciante", "texto"
+    user_messages = [m.content.lower() for m in history.messages if m.type == "human"]
+    for content in user_messages:
+        if "avançad" in content:
+            difficulty = "avançado"
+        elif "intermediári" in content:
+            difficulty = "intermediário"
+        elif "iniciante" in content or "básic" in content:
+            difficulty = "iniciante"
+
+        if "vídeo" in content or "video" in content:
+            format_type = "vídeo"
+        elif "áudio" in content or "audio" in content or "podcast" in content:
+            format_type = "áudio"
+        elif "texto" in content or "ler" in content.split():
+            format_type = "texto"
+    return difficulty, format_type
+
+
+class SnippetIndex:
+    """
+    Serves the lesson snippets materialized offline by
+    `process_rag_docs.materialize_snippets`.
+
+    Every snippet is stored with the embedding of its topic, so a question is
+    matched against the topics and the snippet of the learner's difficulty
+    and format is returned.
+
+    Attributes:
+        store (CompactVectorStore): Index of the snippets.
+        max_distance (float): Largest cosine distance between the question
+                              and a topic that still counts as a match.
+    """
+
+    def __init__(self, store: CompactVectorStore, max_distance: float = 0.15):
+        self.store = store
+        self.max_distance = max_distance
+
+    def lookup(
+        self, embedding: List[float], difficulty: str, format_type: str
+    ) -> Optional[str]:
+        """
+        Return the precomputed snippet for the question, if any topic matches.
+
+        The question is passed already embedded, so the same vector serves the
+        lookup and the document retrieval.
+
+        Parameters
+        ----------
+        embedding : List[float]
+            The embedding of the question asked by the user.
+        difficulty : str
+            The learner's level.
+        format_type : str
+            The learner's preferred format.
+
+        Returns
+        -------
+        Optional[str]
+            The snippet, or None when the question needs a live answer.
+        """
+        k = 2 * SNIPPETS_PER_TOPIC
+        matches = self.store.similarity_search_by_vector_with_score(embedding, k=k)
+        for doc, distance in matches:
+            if distance > self.max_distance:
+                break
+            if (
+                doc.metadata["difficulty"] == difficulty
+                and doc.metadata["format"] == format_type
+            ):
+                return doc.page_content
+        return None
+
+
+def load_snippet_index(directory: str = SNIPPETS_DIR) -> Optional[SnippetIndex]:
+    """
+    Open the snippet index, if the materialization stage has been run.
+
+    Parameters
+    ----------
+    directory : str, optional
+        Directory of the index, by default `data/03_primary/lesson_snippets`.
+
+    Returns
+    -------
+    Optional[SnippetIndex]
+        The index, or None when it was not built.
+    """
+    if not (Path(directory) / MANIFEST_FILE).exists():
+        return None
+    store = CompactVectorStore(
+        directory, OpenAIEmbeddings(model="text-embedding-ada-002")
+    )
+    return SnippetIndex(
+        store, max_distance=float(os.getenv("SNIPPET_MAX_DISTANCE", "0.15"))
+    )
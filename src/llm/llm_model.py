@@ -1,21 +1,29 @@
 import logging
 import os
 import uuid
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
+import openai
 from dotenv import load_dotenv
 from langchain.chains.llm import LLMChain
-from langchain.memory import ChatMessageHistory
-from langchain.prompts import PromptTemplate
 from langchain_community.chat_models import ChatOpenAI
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables.history import RunnableWithMessageHistory
 
+from src.llm.deadline import Deadline, DeadlineExceeded, queue_wait_for, timeout_for
 from src.llm.dinamic_state import (
     ContentRetrievalManager,
     ConversationCoordinator,
     StateController,
 )
+from src.llm.lesson_snippets import SnippetIndex, detect_preferences
+from src.llm.request_coalescing import AnswerCache, RequestCoalescer, make_key
+from src.llm.session_store import ConcurrentUpdateError, SessionState, SessionStore
+from src.llm.upstream_scheduler import (
+    CLIENT_MAX_RETRIES,
+    SchedulerOverloaded,
+    UpstreamScheduler,
+    estimate_tokens,
+)
 
 load_dotenv()
 
@@ -26,43 +34,98 @@ logging.basicConfig(
 )
 
 
-class StudyJourney:
-    def __init__(self, retriever, llm_type="gpt-3.5-turbo"):
-        self.llm = ChatOpenAI(model_name=llm_type, temperature=0)
-        self.session_id = str(uuid.uuid4())
-        self.history = ChatMessageHistory()
-        self.document_manager = ContentRetrievalManager(retriever)
-        self.chatbot = ConversationCoordinator(self.document_manager)
-        self.state_agent = StateController(self.chatbot)
-
-        self.main_prompt_template = PromptTemplate(
-            template="""
-        Você é um assistente de aprendizado interativo da +A Educação. Seu objetivo é
-        ajudar os usuários a se familiarizarem com o sistema e entenderem como você
-        pode ajudá-los.
-
-        Se o usuário disser "oi" ou perguntar "o que você pode fazer?", responda de
-        maneira acolhedora explicando suas funcionalidades:
-        1. Avaliar dificuldades de conhecimento.
-        2. Perguntar sobre preferências de aprendizado.
-        3. Fornecer sugestões de conteúdos adaptados.
-
-        Aqui está a questão do usuário: {question}
-        """,
-            input_variables=["question"],
-        )
+SAVE_SESSION_ATTEMPTS = 3
+COMPLETION_TOKENS = 512
+
+# Seconds of request budget needed to start a stage, kept for the completion
+# while running the earlier stages, and kept for the fallbacks (a cache read
+# and a local snippet search) while waiting for the completion.
+STAGE_MIN_BUDGET = 1.0
+GENERATION_RESERVE = 4.0
+FALLBACK_RESERVE = 0.5
+# Errors that make a stage degrade instead of failing the request. A
+# coalesced call shares its outcome with every waiter, so a waiter with a later
+# deadline can get the upstream timeout of the caller that started the call.
+STAGE_ERRORS = (DeadlineExceeded, SchedulerOverloaded, openai.APIError)
+TIMEOUT_MESSAGE = (
+    "Não consegui concluir a resposta a tempo. Pode repetir a pergunta em instantes?"
+)
+
 
-        self.main_chain = LLMChain(
-            prompt=self.main_prompt_template,
-            llm=self.llm,
-            output_parser=StrOutputParser(),
+class ConversationComponents:
+    """
+    Process-wide, stateless parts of the conversation, built once and shared
+    by every session: the LLM client, the retriever and its document manager,
+    the prompt templates and their chains, the state agents and the
+    coalescing, scheduling, snippet and session store services.
+
+    Attributes:
+        llm (ChatOpenAI): The chat model used to answer the user.
+        deadline_llm (ChatOpenAI): The same model without client retries, used
+                                   for calls bound by a request deadline.
+        document_manager (ContentRetrievalManager): Retrieves and formats documents.
+        chatbot (ConversationCoordinator): Holds the prompt of each state.
+        state_agent (StateController): Predicts the state of a conversation.
+        chains (Dict[str, LLMChain]): One chain per conversation state.
+        answer_cache (AnswerCache): Latest answers, used when a request runs
+                                    out of time.
+    """
+
+    def __init__(
+        self,
+        retriever,
+        llm_type="gpt-3.5-turbo",
+        session_store: Optional[SessionStore] = None,
+        coalescer: Optional[RequestCoalescer] = None,
+        snippet_index: Optional[SnippetIndex] = None,
+        scheduler: Optional[UpstreamScheduler] = None,
+    ):
+        self.llm_type = llm_type
+        self.llm = ChatOpenAI(
+            model_name=llm_type, temperature=0, max_retries=CLIENT_MAX_RETRIES
         )
-        self.chain_with_history = RunnableWithMessageHistory(
-            self.main_chain,
-            get_session_history=lambda session_id: self.history,
-            input_messages_key="question",
-            history_messages_key="chat_history",
+        self.deadline_llm = ChatOpenAI(
+            model_name=llm_type, temperature=0, max_retries=0
+        )
+        self.session_store = session_store
+        self.coalescer = coalescer
+        self.snippet_index = snippet_index
+        self.scheduler = scheduler
+        self.document_manager = ContentRetrievalManager(retriever, coalescer, scheduler)
+        self.chatbot = ConversationCoordinator(self.document_manager)
+        self.state_agent = StateController(self.chatbot, coalescer, scheduler)
+        self.answer_cache = AnswerCache()
+        self.chains: Dict[str, LLMChain] = {
+            state: LLMChain(
+                prompt=prompt, llm=self.llm, output_parser=StrOutputParser()
+            )
+            for state, prompt in self.chatbot.prompts.items()
+        }
+
+
+class StudyJourney:
+    """
+    A single conversation turn-taker, bound to one session.
+
+    It only holds references to the shared `ConversationComponents` and the
+    session's `SessionState`, so creating one per request is cheap.
+    """
+
+    __slots__ = ("components", "session_id", "session", "history", "_loaded_messages")
+
+    def __init__(
+        self,
+        components: ConversationComponents,
+        session_id: Optional[str] = None,
+    ):
+        self.components = components
+        self.session_id = session_id or str(uuid.uuid4())
+        session_store = components.session_store
+        self.session = (
+            session_store.load(self.session_id) if session_store else SessionState()
         )
+        self.history = self.session.history
+        self._loaded_messages = len(self.history.messages)
 
     def add_to_history(self, sender: str, message: str):
         if sender == "user":
@@ -70,24 +133,254 @@ class StudyJourney:
         else:
             self.history.add_ai_message(message)
 
-    def run_interaction(self, question: str, document: str) -> Optional[str]:
+    def save_session(self):
+        """
+        Persist the conversation state in the session store.
+
+        When another request saved the same session in the meantime, the
+        messages of this turn are appended to the latest stored state and the
+        save is retried.
+        """
+        session_store = self.components.session_store
+        if session_store is None:
+            return
+        loaded = self._loaded_messages
+        new_messages = self.history.messages[loaded:]
+        visited_states = self.session.visited_states
+        state = SessionState(
+            messages=self.history.messages,
+            visited_states=visited_states,
+            state=self.session.state,
+            version=self.session.version,
+        )
+        for _ in range(SAVE_SESSION_ATTEMPTS):
+            try:
+                session_store.save(self.session_id, state)
+                break
+            except ConcurrentUpdateError:
+                latest = session_store.load(self.session_id)
+                state.messages = latest.messages + new_messages
+                state.visited_states = latest.visited_states + [
+                    visited
+                    for visited in visited_states
+                    if visited not in latest.visited_states
+                ]
+                state.version = latest.version
+        else:
+            raise ConcurrentUpdateError(self.session_id)
+
+        self.session = state
+        self._loaded_messages = len(state.messages)
+
+    def _invoke_chain(
+        self,
+        chain: LLMChain,
+        question: str,
+        document: str,
+        deadline: Optional[Deadline] = None,
+    ) -> dict:
+        scheduler = self.components.scheduler
+        if scheduler is not None:
+            history = "".join(m.content for m in self.history.messages)
+            prompt_tokens = estimate_tokens(
+                chain.prompt.template, question, document, history
+            )
+            scheduler.acquire(
+                self.components.llm_type,
+                prompt_tokens + COMPLETION_TOKENS,
+                max_wait=queue_wait_for(deadline, scheduler.max_queue_wait),
+            )
+        inputs = {
+            "question": question,
+            "document": document,
+            "chat_history": self.history.messages,
+        }
+        timeout = timeout_for(deadline)
+        if timeout is None:
+            return chain.invoke(inputs)
+        # Bound the upstream request itself, without retries, so it is not
+        # left running after the request has given up on it.
+        llm = self.components.deadline_llm.bind(timeout=timeout)
+        text = (chain.prompt | llm | StrOutputParser()).invoke(inputs)
+        return {**inputs, "text": text}
+
+    def _completion_key(self, chain: LLMChain, question: str, document: str) -> str:
+        """
+        Key identifying a completion: the prompt, the question and the
+        documents, plus the chat history when the prompt uses it.
+        """
+        history = None
+        if "chat_history" in chain.prompt.input_variables:
+            history = [(m.type, m.content) for m in self.history.messages]
+        return make_key(chain.prompt.template, question, document, history)
+
+    def run_interaction(
+        self, question: str, document: str, deadline: Optional[Deadline] = None
+    ) -> Optional[str]:
         """Executes the interaction with the LLM, processing the given question and document details."""
+        chain = self.components.chains[self.session.state]
+        coalescer = self.components.coalescer
         try:
-            response = self.chain_with_history.invoke(
-                {"question": question, "document": document},
-                {"configurable": {"session_id": self.session_id}},
-            )
+            if coalescer is None:
+                response = self._invoke_chain(chain, question, document, deadline)
+            else:
+                response = coalescer.call(
+                    "completion",
+                    self._completion_key(chain, question, document),
+                    lambda: self._invoke_chain(chain, question, document, deadline),
+                )
         except AttributeError as e:
             logging.error(f"Error during LLM interaction: {str(e)}")
             response = "No response available."
             raise
         return response
 
-    def update_prompt(self, next_prompt: PromptTemplate):
-        self.main_prompt_template = next_prompt
-        self.main_chain.prompt = self.main_prompt_template
+    def update_state(self, deadline: Deadline):
+        """
+        Predict the conversation state inside the request budget.
+
+        The prediction runs on a copy of the state, so a call abandoned at the
+        deadline cannot change the session afterwards. When there is no time
+        left for it, the last known state is kept.
+        """
+        if not deadline.allows(STAGE_MIN_BUDGET + GENERATION_RESERVE):
+            logging.warning("Prazo curto: mantendo o último estado conhecido.")
+            return
+        probe = SessionState(
+            visited_states=list(self.session.visited_states),
+            state=self.session.state,
+        )
+        stage = deadline.stage(GENERATION_RESERVE)
+        try:
+            stage.run(
+                lambda: self.components.state_agent.handle_input(
+                    self.history, probe, stage
+                )
+            )
+        except STAGE_ERRORS as e:
+            logging.warning(f"Estado não atualizado ({type(e).__name__}).")
+            return
+        self.session.state = probe.state
+        self.session.visited_states = probe.visited_states
+
+    def embed_question(
+        self, question: str, deadline: Deadline
+    ) -> Optional[List[float]]:
+        """
+        Embed the question once, for both the snippet lookup and the retrieval.
+
+        Returns None when there is no time left for it, in which case both are
+        skipped.
+        """
+        if not deadline.allows(STAGE_MIN_BUDGET + GENERATION_RESERVE):
+            logging.warning("Prazo curto: resposta sem busca de documentos.")
+            return None
+        document_manager = self.components.document_manager
+        stage = deadline.stage(GENERATION_RESERVE)
+        try:
+            return stage.run(lambda: document_manager.embed_query(question, stage))
+        except STAGE_ERRORS as e:
+            logging.warning(f"Pergunta não vetorizada ({type(e).__name__}).")
+            return None
+
+    def retrieve_documents(
+        self, question: str, embedding: Optional[List[float]], deadline: Deadline
+    ) -> str:
+        """Retrieve and format the documents, or skip retrieval when time is short."""
+        if embedding is None:
+            return ""
+        if not deadline.allows(STAGE_MIN_BUDGET + GENERATION_RESERVE):
+            logging.warning("Prazo curto: resposta sem busca de documentos.")
+            return ""
+        document_manager = self.components.document_manager
+        stage = deadline.stage(GENERATION_RESERVE)
+        try:
+            retrieved_docs = stage.run(
+                lambda: document_manager.get_product_details(question, embedding, stage)
+            )
+        except STAGE_ERRORS as e:
+            logging.warning(f"Busca de documentos ignorada ({type(e).__name__}).")
+            return ""
+        return document_manager.format_docs(retrieved_docs)
+
+    def lookup_snippet(self, embedding: Optional[List[float]]) -> Optional[str]:
+        # A local search over the precomputed embedding, cheap enough to run
+        # with whatever is left of the budget.
+        snippet_index = self.components.snippet_index
+        if snippet_index is None or embedding is None:
+            return None
+        difficulty, format_type = detect_preferences(self.history)
+        snippet = snippet_index.lookup(embedding, difficulty, format_type)
+        if snippet is not None:
+            logging.info(f"Conteúdo pré-gerado usado ({difficulty}, {format_type}).")
+        return snippet
+
+    def get_snippet(
+        self, question: str, embedding: Optional[List[float]]
+    ) -> Optional[dict]:
+        """
+        Look up a precomputed lesson snippet for the question.
+
+        Only used in the main stage, with the level and format detected in the
+        conversation. Returns None when the question needs a live answer.
+        """
+        if self.session.state != "main":
+            return None
+        snippet = self.lookup_snippet(embedding)
+        if snippet is None:
+            return None
+        return {"question": question, "text": snippet}
+
+    def generate(
+        self,
+        question: str,
+        document: str,
+        embedding: Optional[List[float]],
+        deadline: Deadline,
+    ) -> dict:
+        """
+        Generate the answer, degrading gracefully when the budget runs out.
+
+        Without enough time for the completion, the answer comes from the
+        answer cache, then from the lesson snippets. If neither has one, a
+        request shed by the upstream scheduler is re-raised (503 with
+        Retry-After) and a timed out or failed one gets a short apology
+        message.
+        """
+        # Answers are shared between learners, so the key only holds what the
+        # prompt actually sees (see `_completion_key`).
+        chain = self.components.chains[self.session.state]
+        cache_key = self._completion_key(chain, question, document)
+        overloaded = None
+        if deadline.allows(STAGE_MIN_BUDGET):
+            stage = deadline.stage(FALLBACK_RESERVE)
+            try:
+                response = stage.run(
+                    lambda: self.run_interaction(question, document, stage)
+                )
+                self.components.answer_cache.put(cache_key, response["text"])
+                return response
+            except DeadlineExceeded:
+                logging.warning("Geração excedeu o prazo, usando alternativas.")
+            except SchedulerOverloaded as e:
+                overloaded = e
+            except openai.APIError as e:
+                logging.warning(
+                    f"Geração falhou ({type(e).__name__}), usando alternativas."
+                )
+
+        answer = self.components.answer_cache.get(cache_key)
+        if answer is None:
+            answer = self.lookup_snippet(embedding)
+        if answer is None:
+            if overloaded is not None:
+                raise overloaded
+            answer = TIMEOUT_MESSAGE
+        return {"question": question, "text": answer}
 
-    def get_answer(self, question: str) -> Tuple[str, Optional[str]]:
+    def get_answer(
+        self, question: str, deadline: Optional[Deadline] = None
+    ) -> Tuple[str, Optional[str]]:
         """
         Get an answer from the LLM based on the stage of interaction.
 
@@ -98,10 +391,10 @@ class StudyJourney:
         ----------
         question : str
             The question asked by the user.
-        retriever : Chroma
-            The retriever used to get relevant documents.
-        stage : str, optional
-            The stage of interaction, by default "main".
+        deadline : Deadline, optional
+            Budget of the request, by default unbounded. As it runs out, the
+            last known state is kept, retrieval is skipped and the answer
+            comes from the answer cache or the lesson snippets.
 
         Returns
         -------
@@ -109,13 +402,16 @@ class StudyJourney:
             A tuple containing the response message and the formatted documents
             (if applicable).
         """
+        deadline = deadline or Deadline()
         self.add_to_history("user", question)
-        retrieved_docs = self.document_manager.get_product_details(question)
-        formatted_docs = self.document_manager.format_docs(retrieved_docs)
-        next_prompt = self.state_agent.handle_input(self.history)
-        self.update_prompt(next_prompt)
-        response = self.run_interaction(question, formatted_docs)
+        self.update_state(deadline)
+        embedding = self.embed_question(question, deadline)
+        response = self.get_snippet(question, embedding)
+        if response is None:
+            formatted_docs = self.retrieve_documents(question, embedding, deadline)
+            response = self.generate(question, formatted_docs, embedding, deadline)
         response_text = response.get("text", "Sem resposta disponível.")
         self.add_to_history("ai", response_text)
+        self.save_session()
 
         return response
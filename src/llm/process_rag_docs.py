@@ -1,5 +1,6 @@
 import json
 import logging
+import math
 import os
 from pathlib import Path
 from typing import List, Tuple
@@ -8,6 +9,7 @@ import assemblyai as aai
 import nest_asyncio
 import pytesseract
 from dotenv import load_dotenv
+from langchain.chains.llm import LLMChain
 from langchain.docstore.document import Document as LangchainDocument
 from langchain.document_loaders import (
     AssemblyAIAudioTranscriptLoader,
@@ -15,12 +17,22 @@ from langchain.document_loaders import (
     TextLoader,
 )
 from langchain.embeddings.openai import OpenAIEmbeddings
+from langchain.prompts import PromptTemplate
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.chat_models import ChatOpenAI
 from langchain_community.vectorstores import Chroma
+from langchain_core.output_parsers import StrOutputParser
 from llama_parse import LlamaParse
 from moviepy.editor import VideoFileClip
 from PIL import Image
 
+from llm.upstream_scheduler import (
+    CLIENT_MAX_RETRIES,
+    Priority,
+    UpstreamScheduler,
+    estimate_tokens,
+)
+from llm.vector_store import CompactVectorStore, index_settings_from_env
 from utils import load_from_file, save_to_file
 
 load_dotenv()
@@ -38,6 +50,37 @@ aai.settings.api_key = aai_api_key
 
 logs = logging.basicConfig(level=logging.INFO)
 
+SNIPPET_DIFFICULTIES = ("iniciante", "intermediário", "avançado")
+SNIPPET_FORMATS = {
+    "texto": "uma explicação curta em texto, seguida de uma pergunta de fixação",
+    "vídeo": "um roteiro de vídeo de até um minuto, com cenas e narração",
+    "áudio": "um roteiro de áudio de até um minuto, em linguagem falada",
+}
+
+TOPICS_PROMPT = PromptTemplate(
+    template="""
+    Você é um especialista em fundamentos de programação. Liste os conceitos
+    ensinados nos trechos abaixo, um por linha, sem numeração e sem explicações.
+    Use nomes curtos, como "estruturas de repetição" ou "variáveis e tipos".
+
+    Trechos:
+    {document}
+    """,
+    input_variables=["document"],
+)
+
+SNIPPET_PROMPT = PromptTemplate(
+    template="""
+    Você é um assistente de aprendizado interativo da +A Educação. Crie um
+    conteúdo curto sobre "{topic}" para um aluno de nível {difficulty}, no
+    formato de {format}.
+
+    Use exclusivamente o que estiver em: \n\n {document} \n\n
+    Não invente informações que não estejam nos trechos.
+    """,
+    input_variables=["topic", "difficulty", "format", "document"],
+)
+
 
 def process_json_data(data: dict) -> List[LangchainDocument]:
     """Process JSON data and create structured documents.
@@ -356,4 +399,125 @@ def load_data():
         persist_directory=chroma_db_dir,
     )
     logs.info("Chroma DB salvo com sucesso.")
+
+    compact_index_dir = "../data/03_primary/compact_index"
+    CompactVectorStore.from_chroma(
+        docsearch, compact_index_dir, **index_settings_from_env()
+    )
     return docs, docsearch
+
+
+def extract_topics(
+    docs: List[LangchainDocument],
+    llm: ChatOpenAI,
+    scheduler: UpstreamScheduler,
+    batch_size: int = 8,
+) -> List[str]:
+    """Extract the distinct concepts taught in the indexed chunks.
+
+    Parameters
+    ----------
+    docs : List[LangchainDocument]
+        The indexed documents.
+    llm : ChatOpenAI
+        The model used to name the concepts.
+    scheduler : UpstreamScheduler
+        Rate limits the requests, with ingest priority.
+    batch_size : int, optional
+        Number of chunks sent per request, by default 8.
+
+    Returns
+    -------
+    List[str]
+        The topics, without duplicates.
+    """
+    chain = LLMChain(prompt=TOPICS_PROMPT, llm=llm, output_parser=StrOutputParser())
+    topics = {}
+    for start in range(0, len(docs), batch_size):
+        end = start + batch_size
+        batch = docs[start:end]
+        document = "\n\n".join(doc.page_content for doc in batch)
+        scheduler.acquire(
+            "gpt-3.5-turbo",
+            estimate_tokens(TOPICS_PROMPT.template, document) + 256,
+            Priority.INGEST,
+            max_wait=math.inf,
+        )
+        response = chain.invoke({"document": document})["text"]
+        for line in response.splitlines():
+            topic = line.strip(" -•*\t").strip()
+            if topic:
+                topics.setdefault(topic.lower(), topic)
+    return list(topics.values())
+
+
+def materialize_snippets(
+    docs: List[LangchainDocument],
+    docsearch: Chroma,
+    snippets_dir: str = "../data/03_primary/lesson_snippets",
+) -> CompactVectorStore:
+    """Generate short lesson snippets per topic, difficulty and format.
+
+    Runs after `load_data`. Every snippet is generated from the chunks
+    retrieved for its topic and stored with the topic embedding, so the API
+    can serve it without a live LLM call when a learner asks about the topic.
+
+    Parameters
+    ----------
+    docs : List[LangchainDocument]
+        The indexed documents.
+    docsearch : Chroma
+        The vector store built by `load_data`.
+    snippets_dir : str, optional
+        Directory of the snippet index.
+
+    Returns
+    -------
+    CompactVectorStore
+        The snippet index.
+    """
+    llm = ChatOpenAI(
+        model_name="gpt-3.5-turbo", temperature=0, max_retries=CLIENT_MAX_RETRIES
+    )
+    chain = LLMChain(prompt=SNIPPET_PROMPT, llm=llm, output_parser=StrOutputParser())
+    embedding = OpenAIEmbeddings(model="text-embedding-ada-002")
+
+    # Separate process with its own buckets, limited to the offline share of
+    # the account limits so it can run alongside the API.
+    scheduler = UpstreamScheduler.from_env(offline=True)
+
+    topics = extract_topics(docs, llm, scheduler)
+    topic_embeddings = embedding.embed_documents(topics)
+    logging.info(f"{len(topics)} tópicos encontrados para os conteúdos pré-gerados.")
+
+    texts, embeddings, metadatas = [], [], []
+    for topic, topic_embedding in zip(topics, topic_embeddings):
+        topic_docs = docsearch.similarity_search(topic, k=4)
+        document = "\n\n".join(doc.page_content for doc in topic_docs)
+        for difficulty in SNIPPET_DIFFICULTIES:
+            for format_type, format_description in SNIPPET_FORMATS.items():
+                scheduler.acquire(
+                    "gpt-3.5-turbo",
+                    estimate_tokens(SNIPPET_PROMPT.template, document) + 512,
+                    Priority.INGEST,
+                    max_wait=math.inf,
+                )
+                response = chain.invoke(
+                    {
+                        "topic": topic,
+                        "difficulty": difficulty,
+                        "format": format_description,
+                        "document": document,
+                    }
+                )
+                texts.append(response["text"])
+                embeddings.append(topic_embedding)
+                metadatas.append(
+                    {"topic": topic, "difficulty": difficulty, "format": format_type}
+                )
+
+    snippets = CompactVectorStore.build(
+        snippets_dir, texts, embeddings, embedding, metadatas
+    )
+    logging.info("Conteúdos pré-gerados salvos com sucesso.")
+    return snippets
@@ -0,0 +1,222 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+def make_key(*parts: Any) -> str:
+    """Build a short, stable key from the parts that identify an upstream call."""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(repr(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class LatencyTracker:
+    """
+    Rolling window of the latest upstream latencies of one kind of call.
+
+    Attributes:
+        window (int): Number of samples kept.
+    """
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> float:
+        """
+        Return the q-th percentile (0-100) of the recorded latencies.
+
+        Parameters
+        ----------
+        q : float
+            The percentile to compute.
+
+        Returns
+        -------
+        float
+            The latency in seconds, or 0.0 when nothing was recorded.
+        """
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))
+        return samples[index]
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls that share the same key.
+
+    The first caller of a key runs the function; callers arriving while it
+    is in flight wait for and receive the same result (or exception). The
+    key is released as soon as the call finishes, so nothing is cached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight: Dict[Hashable, Future] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+
+class AnswerCache:
+    """
+    Small LRU cache of the latest generated answers, used as a fallback when
+    a request runs out of time before the completion finishes.
+
+    Attributes:
+        max_size (int): Maximum number of answers kept.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._answers: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is not None:
+                self._answers.move_to_end(key)
+            return answer
+
+    def put(self, key: Hashable, answer: str):
+        with self._lock:
+            self._answers[key] = answer
+            self._answers.move_to_end(key)
+            if len(self._answers) > self.max_size:
+                self._answers.popitem(last=False)
+
+
+class RequestCoalescer:
+    """
+    Process-wide layer between the conversation components and the upstream
+    services (embeddings, retrieval, state agent and completions).
+
+    Identical in-flight calls are coalesced with `SingleFlight`. When hedging
+    is enabled, a call still running after the p95 latency of its kind gets a
+    second, identical request and the first answer to arrive is used. The
+    losing request is not cancelled, only ignored.
+
+    Attributes:
+        hedge (bool): Whether slow calls are hedged.
+        hedge_min_samples (int): Latencies needed before hedging starts.
+        hedge_min_delay (float): Lower bound, in seconds, of the hedge delay.
+    """
+
+    def __init__(
+        self,
+        hedge: bool = False,
+        hedge_percentile: float = 95.0,
+        hedge_min_samples: int = 20,
+        hedge_min_delay: float = 0.05,
+        max_workers: int = 32,
+    ):
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_min_delay = hedge_min_delay
+        self._single_flight = SingleFlight()
+        self._latencies: Dict[str, LatencyTracker] = {}
+        self._latencies_lock = threading.Lock()
+        self._executor = (
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge")
+            if hedge
+            else None
+        )
+
+    def latency(self, kind: str) -> LatencyTracker:
+        with self._latencies_lock:
+            if kind not in self._latencies:
+                self._latencies[kind] = LatencyTracker()
+            return self._latencies[kind]
+
+    def call(self, kind: str, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """
+        Run an upstream call, sharing it with identical in-flight calls.
+
+        Parameters
+        ----------
+        kind : str
+            The kind of call ("retrieval", "state", "completion"), used to
+            separate keys and latency statistics.
+        key : Hashable
+            Identifies the call; callers with equal keys share one result.
+        fn : Callable[[], Any]
+            The upstream call.
+
+        Returns
+        -------
+        Any
+            The result of the upstream call.
+        """
+        return self._single_flight.do((kind, key), lambda: self._run(kind, fn))
+
+    def _timed(self, kind: str, fn: Callable[[], Any]) -> Any:
+        start = time.perf_counter()
+        result = fn()
+        self.latency(kind).record(time.perf_counter() - start)
+        return result
+
+    def hedge_delay(self, kind: str) -> Optional[float]:
+        """Return the delay before hedging a call, or None if it should not be hedged."""
+        tracker = self.latency(kind)
+        if not self.hedge or len(tracker) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, tracker.percentile(self.hedge_percentile))
+
+    def _run(self, kind: str, fn: Callable[[], Any]) -> Any:
+        delay = self.hedge_delay(kind)
+        if delay is None:
+            return self._timed(kind, fn)
+
+        primary = self._executor.submit(self._timed, kind, fn)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+
+        logging.info(
+            f"Chamada '{kind}' acima de {delay:.2f}s, enviando requisição hedge."
+        )
+        pending = {primary, self._executor.submit(self._timed, kind, fn)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
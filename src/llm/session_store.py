@@ -0,0 +1,312 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import List, Optional
+
+from langchain.memory import ChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
+
+DEFAULT_SESSION_STORE_URL = "sqlite:///data/03_primary/sessions.db"
+
+# Seconds of inactivity before a session expires.
+DEFAULT_SESSION_TTL = 86400
+
+
+class ConcurrentUpdateError(Exception):
+    """Raised when a session was saved by another request since it was loaded."""
+
+
+class SessionState:
+    """
+    Conversation state of a single user, detached from the LLM components.
+
+    Attributes:
+        messages (List[BaseMessage]): The chat history of the session.
+        visited_states (List[str]): States the conversation has already visited.
+        state (str): The current state of the conversation flow.
+        version (int): Version read from the store, used for optimistic
+                       concurrency (0 for a session that was never saved).
+    """
+
+    __slots__ = ("messages", "visited_states", "state", "version")
+
+    def __init__(
+        self,
+        messages: Optional[List[BaseMessage]] = None,
+        visited_states: Optional[List[str]] = None,
+        state: str = "intro",
+        version: int = 0,
+    ):
+        self.messages = messages or []
+        self.visited_states = visited_states or []
+        self.state = state
+        self.version = version
+
+    @property
+    def history(self) -> ChatMessageHistory:
+        return ChatMessageHistory(messages=list(self.messages))
+
+    def dumps(self) -> bytes:
+        """
+        Serialize the state into a compact, compressed payload.
+
+        Messages are stored as `[kind, content]` pairs, where kind is "h" for
+        user messages and "a" for assistant messages.
+
+        Returns
+        -------
+        bytes
+            The zlib-compressed JSON payload.
+        """
+        payload = {
+            "m": [
+                ["h" if isinstance(message, HumanMessage) else "a", message.content]
+                for message in self.messages
+            ],
+            "v": self.visited_states,
+            "s": self.state,
+        }
+        return zlib.compress(
+            json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode(
+                "utf-8"
+            )
+        )
+
+    @classmethod
+    def loads(cls, data: bytes, version: int) -> "SessionState":
+        """
+        Rebuild a state from a payload produced by `dumps`.
+
+        Parameters
+        ----------
+        data : bytes
+            The compressed payload.
+        version : int
+            The version stored alongside the payload.
+
+        Returns
+        -------
+        SessionState
+            The deserialized state.
+        """
+        payload = json.loads(zlib.decompress(data))
+        messages = [
+            HumanMessage(content=content) if kind == "h" else AIMessage(content=content)
+            for kind, content in payload["m"]
+        ]
+        return cls(messages, payload["v"], payload["s"], version)
+
+
+class SessionStore(ABC):
+    """
+    Backend that persists `SessionState` objects between requests.
+
+    Saving uses optimistic concurrency: `save` only succeeds when the stored
+    version still matches `state.version`, and bumps it on success. Otherwise
+    it raises `ConcurrentUpdateError` and the caller must reload and merge.
+    """
+
+    @abstractmethod
+    def load(self, session_id: str) -> SessionState:
+        """Return the stored state, or a fresh one for an unknown session."""
+
+    @abstractmethod
+    def save(self, session_id: str, state: SessionState) -> None:
+        """Store the state if nobody saved the session since it was loaded."""
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    File-backed session store, shared by every worker of the same host.
+
+    Sessions not saved for `ttl` seconds are deleted; the purge runs while
+    saving, at most every `purge_interval` seconds per process.
+
+    Attributes:
+        path (str): Path of the SQLite database file.
+        ttl (int): Seconds of inactivity before a session expires.
+        purge_interval (float): Minimum number of seconds between purges.
+    """
+
+    def __init__(
+        self, path: str, ttl: int = DEFAULT_SESSION_TTL, purge_interval: float = 300.0
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._last_purge = 0.0
+        self._local = threading.local()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "id TEXT PRIMARY KEY, version INTEGER NOT NULL, payload BLOB NOT NULL, "
+                "updated_at REAL NOT NULL DEFAULT 0)"
+            )
+            columns = [
+                row[1] for row in connection.execute("PRAGMA table_info(sessions)")
+            ]
+            if "updated_at" not in columns:
+                connection.execute(
+                    "ALTER TABLE sessions ADD COLUMN updated_at REAL NOT NULL DEFAULT 0"
+                )
+                connection.execute("UPDATE sessions SET updated_at = ?", (time.time(),))
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5.0)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def load(self, session_id: str) -> SessionState:
+        row = (
+            self._connection()
+            .execute(
+                "SELECT version, payload FROM sessions WHERE id = ?", (session_id,)
+            )
+            .fetchone()
+        )
+        if row is None:
+            return SessionState()
+        version, payload = row
+        return SessionState.loads(payload, version)
+
+    def save(self, session_id: str, state: SessionState) -> None:
+        now = time.time()
+        with self._connection() as connection:
+            if state.version == 0:
+                cursor = connection.execute(
+                    "INSERT OR IGNORE INTO sessions (id, version, payload, updated_at) "
+                    "VALUES (?, 1, ?, ?)",
+                    (session_id, state.dumps(), now),
+                )
+            else:
+                cursor = connection.execute(
+                    "UPDATE sessions SET version = version + 1, payload = ?, "
+                    "updated_at = ? WHERE id = ? AND version = ?",
+                    (state.dumps(), now, session_id, state.version),
+                )
+        if cursor.rowcount == 0:
+            raise ConcurrentUpdateError(session_id)
+        state.version += 1
+        if now - self._last_purge >= self.purge_interval:
+            self.purge(now)
+
+    def purge(self, now: Optional[float] = None) -> int:
+        """
+        Delete the sessions that expired.
+
+        Parameters
+        ----------
+        now : float, optional
+            Current `time.time()`, by default read from the clock.
+
+        Returns
+        -------
+        int
+            The number of deleted sessions.
+        """
+        now = time.time() if now is None else now
+        self._last_purge = now
+        with self._connection() as connection:
+            cursor = connection.execute(
+                "DELETE FROM sessions WHERE updated_at < ?", (now - self.ttl,)
+            )
+        return cursor.rowcount
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Session store for any Redis-compatible server (Redis, Valkey, KeyDB or a
+    local stand-in such as fakeredis), shared by every API replica.
+
+    Each session is a hash with `version` and `payload` fields, updated inside
+    a WATCH/MULTI/EXEC transaction.
+
+    Attributes:
+        client: A `redis.Redis`-compatible client.
+        prefix (str): Prefix prepended to the session keys.
+        ttl (int): Seconds of inactivity before a session expires.
+    """
+
+    def __init__(
+        self,
+        client,
+        prefix: str = "study_journey:session:",
+        ttl: int = DEFAULT_SESSION_TTL,
+    ):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "RedisSessionStore":
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError(
+                "Instale o pacote `redis` para usar o RedisSessionStore."
+            ) from e
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def load(self, session_id: str) -> SessionState:
+        version, payload = self.client.hmget(
+            self.prefix + session_id, "version", "payload"
+        )
+        if payload is None:
+            return SessionState()
+        return SessionState.loads(payload, int(version))
+
+    def save(self, session_id: str, state: SessionState) -> None:
+        from redis.exceptions import WatchError
+
+        key = self.prefix + session_id
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                stored_version = int(pipe.hget(key, "version") or 0)
+                if stored_version != state.version:
+                    raise ConcurrentUpdateError(session_id)
+                pipe.multi()
+                pipe.hset(
+                    key,
+                    mapping={"version": state.version + 1, "payload": state.dumps()},
+                )
+                pipe.expire(key, self.ttl)
+                pipe.execute()
+            except WatchError as e:
+                raise ConcurrentUpdateError(session_id) from e
+        state.version += 1
+
+
+def create_session_store(url: str = DEFAULT_SESSION_STORE_URL) -> SessionStore:
+    """
+    Build the session store described by a URL.
+
+    Parameters
+    ----------
+    url : str, optional
+        `sqlite:///<path>` for the file-backed store or `redis://...` /
+        `rediss://...` for a Redis-compatible server, by default a SQLite file
+        in `data/03_primary`.
+
+    Returns
+    -------
+    SessionStore
+        The configured store.
+    """
+    if url.startswith("sqlite:///"):
+        return SQLiteSessionStore(url.replace("sqlite:///", "", 1))
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisSessionStore.from_url(url)
+    raise ValueError(f"SESSION_STORE_URL não suportada: {url}")
@@ -0,0 +1,315 @@
+import heapq
+import itertools
+import math
+import os
+import threading
+import time
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+# Requests and tokens per minute allowed for each model on the whole account.
+DEFAULT_RATE_LIMITS = {
+    "gpt-3.5-turbo": (3500, 160000),
+    "text-embedding-ada-002": (3000, 1000000),
+}
+FALLBACK_RATE_LIMIT = (500, 60000)
+
+# Fraction of the account limits kept for the offline pipeline; the API
+# workers split the rest (`LLM_INGEST_SHARE`).
+DEFAULT_INGEST_SHARE = 0.2
+
+# Retries made by the OpenAI clients themselves bypass the scheduler, so they
+# are kept to one.
+CLIENT_MAX_RETRIES = 1
+
+
+class Priority(IntEnum):
+    """
+    Scheduling class of an upstream call; lower values are served first.
+
+    Priorities only order the calls waiting in the same scheduler. The API
+    only makes interactive calls, and the offline pipeline
+    (`process_rag_docs.materialize_snippets`) runs in its own process with its
+    own scheduler, so `BATCH` and `INGEST` never compete with `/query` traffic
+    for a bucket; the two are kept apart by splitting the account limits
+    instead (see `UpstreamScheduler.from_env`). `BATCH` is not used yet.
+    """
+
+    INTERACTIVE = 0
+    BATCH = 1
+    INGEST = 2
+
+
+class SchedulerOverloaded(Exception):
+    """
+    Raised when a call would wait in the queue longer than its deadline.
+
+    Attributes:
+        model (str): The model whose queue is saturated.
+        retry_after (int): Suggested number of seconds before retrying.
+    """
+
+    def __init__(self, model: str, retry_after: int):
+        super().__init__(
+            f"Fila do modelo {model} saturada, tente novamente em {retry_after}s."
+        )
+        self.model = model
+        self.retry_after = retry_after
+
+
+def estimate_tokens(*texts: str) -> int:
+    """Cheap token estimate (about 4 characters per token) for rate limiting."""
+    return sum(len(text) for text in texts) // 4 + 1
+
+
+def parse_rate_limits(value: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Parse limits written as `model=rpm:tpm,model=rpm:tpm`.
+
+    Parameters
+    ----------
+    value : str
+        The limits, as found in the `LLM_RATE_LIMITS` environment variable.
+
+    Returns
+    -------
+    Dict[str, Tuple[int, int]]
+        Requests and tokens per minute by model.
+    """
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        model, rates = item.split("=")
+        rpm, tpm = rates.split(":")
+        limits[model.strip()] = (int(rpm), int(tpm))
+    return limits
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously up to one minute of budget.
+
+    Attributes:
+        capacity (float): Maximum number of tokens in the bucket.
+        rate (float): Tokens added per second.
+        tokens (float): Tokens currently available.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available, assuming no other use."""
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+
+class _ModelQueue:
+    """Buckets and priority queue of the calls waiting for one model."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.waiting: List[Tuple[int, int, int]] = []
+        self.admitted = 0
+        self.shed = 0
+
+    def refill(self, now: float):
+        self.requests.refill(now)
+        self.tokens.refill(now)
+
+    def wait_time(self, requests: int, tokens: int) -> float:
+        return max(self.requests.wait_time(requests), self.tokens.wait_time(tokens))
+
+    def estimated_wait(self, priority: int, tokens: int) -> float:
+        """Time to serve every queued call of equal or higher priority, plus this one."""
+        ahead = [entry for entry in self.waiting if entry[0] <= priority]
+        return self.wait_time(len(ahead) + 1, sum(entry[2] for entry in ahead) + tokens)
+
+
+class UpstreamScheduler:
+    """
+    Admission control for the upstream LLM and embedding APIs.
+
+    Each model has token buckets for requests and tokens per minute. Calls
+    wait in a priority queue, so interactive traffic is served before batch
+    and ingest traffic, and are rejected with `SchedulerOverloaded` as soon
+    as their expected wait exceeds their deadline, instead of piling up and
+    hitting 429 responses upstream.
+
+    Buckets live in the current process. `from_env` gives each uvicorn
+    worker, and the offline pipeline, its share of the account limits.
+
+    Attributes:
+        limits (Dict[str, Tuple[int, int]]): Requests and tokens per minute
+                                             by model.
+        max_queue_wait (float): Default deadline, in seconds, to leave the queue.
+        fallback_limit (Tuple[int, int]): Limits of the models missing from
+                                          `limits`.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[Dict[str, Tuple[int, int]]] = None,
+        max_queue_wait: float = 10.0,
+        fallback_limit: Tuple[int, int] = FALLBACK_RATE_LIMIT,
+    ):
+        self.limits = limits or dict(DEFAULT_RATE_LIMITS)
+        self.max_queue_wait = max_queue_wait
+        self.fallback_limit = fallback_limit
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+
+    @classmethod
+    def from_env(cls, offline: bool = False) -> "UpstreamScheduler":
+        """
+        Build a scheduler from `LLM_RATE_LIMITS` and `LLM_MAX_QUEUE_WAIT`.
+
+        `LLM_RATE_LIMITS` holds the account limits. The offline pipeline gets
+        `LLM_INGEST_SHARE` of them and the uvicorn workers (`API_WORKERS`, 1
+        when unset) split the rest evenly, so both can run at the same time
+        without exceeding the account limits.
+
+        Parameters
+        ----------
+        offline : bool, optional
+            Whether the scheduler is for the offline pipeline rather than an
+            API worker, by default False.
+
+        Returns
+        -------
+        UpstreamScheduler
+            The scheduler with this process' share of the limits.
+        """
+        ingest_share = float(os.getenv("LLM_INGEST_SHARE", DEFAULT_INGEST_SHARE))
+        if not 0.0 < ingest_share < 1.0:
+            raise ValueError(f"LLM_INGEST_SHARE deve estar entre 0 e 1: {ingest_share}")
+        if offline:
+            fraction = ingest_share
+        else:
+            fraction = (1.0 - ingest_share) / int(os.getenv("API_WORKERS", "1"))
+        limits = dict(DEFAULT_RATE_LIMITS)
+        limits.update(parse_rate_limits(os.getenv("LLM_RATE_LIMITS", "")))
+
+        def share(rates: Tuple[int, int]) -> Tuple[int, int]:
+            return max(1, int(rates[0] * fraction)), max(1, int(rates[1] * fraction))
+
+        return cls(
+            {model: share(rates) for model, rates in limits.items()},
+            float(os.getenv("LLM_MAX_QUEUE_WAIT", "10")),
+            share(FALLBACK_RATE_LIMIT),
+        )
+
+    def _queue(self, model: str) -> _ModelQueue:
+        if model not in self._queues:
+            self._queues[model] = _ModelQueue(
+                *self.limits.get(model, self.fallback_limit)
+            )
+        return self._queues[model]
+
+    def acquire(
+        self,
+        model: str,
+        tokens: int,
+        priority: Priority = Priority.INTERACTIVE,
+        max_wait: Optional[float] = None,
+    ):
+        """
+        Block until the call may be sent upstream.
+
+        Parameters
+        ----------
+        model : str
+            The model that will be called.
+        tokens : int
+            Estimated prompt plus completion tokens of the call.
+        priority : Priority, optional
+            Scheduling class, by default `Priority.INTERACTIVE`.
+        max_wait : float, optional
+            Seconds the call may wait in the queue (`math.inf` to never shed
+            it), by default `max_queue_wait`.
+
+        Raises
+        ------
+        SchedulerOverloaded
+            When the expected or actual wait exceeds `max_wait`.
+        """
+        if max_wait is None:
+            max_wait = self.max_queue_wait
+
+        with self._condition:
+            queue = self._queue(model)
+            now = time.monotonic()
+            queue.refill(now)
+            estimated_wait = queue.estimated_wait(priority, tokens)
+            if estimated_wait > max_wait:
+                queue.shed += 1
+                raise SchedulerOverloaded(model, math.ceil(estimated_wait))
+
+            entry = (int(priority), next(self._sequence), tokens)
+            heapq.heappush(queue.waiting, entry)
+            deadline = now + max_wait
+            try:
+                while True:
+                    now = time.monotonic()
+                    queue.refill(now)
+                    if queue.waiting[0] is entry and queue.wait_time(1, tokens) == 0:
+                        heapq.heappop(queue.waiting)
+                        queue.requests.take(1)
+                        queue.tokens.take(tokens)
+                        queue.admitted += 1
+                        return
+                    if now >= deadline:
+                        queue.shed += 1
+                        raise SchedulerOverloaded(
+                            model, math.ceil(queue.estimated_wait(priority, tokens))
+                        )
+                    head_tokens = queue.waiting[0][2]
+                    timeout = min(
+                        max(queue.wait_time(1, head_tokens), 0.01), deadline - now
+                    )
+                    self._condition.wait(timeout)
+            finally:
+                if entry in queue.waiting:
+                    queue.waiting.remove(entry)
+                    heapq.heapify(queue.waiting)
+                self._condition.notify_all()
+
+    def metrics(self) -> Dict[str, dict]:
+        """
+        Snapshot of the queues, published by the API `/metrics` endpoint.
+
+        Returns
+        -------
+        Dict[str, dict]
+            For each model: queue depth by priority, admitted and shed calls,
+            and the requests and tokens currently available.
+        """
+        with self._condition:
+            now = time.monotonic()
+            snapshot = {}
+            for model, queue in self._queues.items():
+                queue.refill(now)
+                depth = {priority.name.lower(): 0 for priority in Priority}
+                for entry in queue.waiting:
+                    depth[Priority(entry[0]).name.lower()] += 1
+                snapshot[model] = {
+                    "queue_depth": depth,
+                    "admitted": queue.admitted,
+                    "shed": queue.shed,
+                    "requests_available": int(queue.requests.tokens),
+                    "tokens_available": int(queue.tokens.tokens),
+                }
+            return snapshot
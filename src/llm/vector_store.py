@@ -0,0 +1,467 @@
+import fcntl
+import json
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document as LangchainDocument
+from langchain_community.vectorstores import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+MANIFEST_FILE = "manifest.json"
+SUPPORTED_DTYPES = ("float16", "int8")
+SEARCH_BLOCK_ROWS = 4096
+
+
+def index_settings_from_env() -> dict:
+    """
+    Build settings of the compact index, read from the environment.
+
+    Shared by every place that builds the index, so a rebuild keeps the
+    storage type and IVF layout it was configured with.
+
+    Returns
+    -------
+    dict
+        `dtype` (`COMPACT_INDEX_DTYPE`, "float16" by default) and `n_lists`
+        (`COMPACT_INDEX_LISTS`, 0 by default), to pass to `build`.
+    """
+    return {
+        "dtype": os.getenv("COMPACT_INDEX_DTYPE", "float16"),
+        "n_lists": int(os.getenv("COMPACT_INDEX_LISTS", "0")),
+    }
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale each row to unit length so that dot products are cosine similarities."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def _quantize(vectors: np.ndarray, dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Quantize unit-length float32 vectors to the storage dtype.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        The normalized float32 matrix, one embedding per row.
+    dtype : str
+        Either "float16" or "int8".
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The quantized matrix and the per-row scale factors (all ones for
+        float16).
+    """
+    if dtype == "float16":
+        return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(vectors / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def _kmeans(
+    vectors: np.ndarray, n_lists: int, n_iter: int = 20, seed: int = 42
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Spherical k-means used to build the inverted file lists.
+
+    Parameters
+    ----------
+    vectors : np.ndarray
+        The normalized float32 matrix to be clustered.
+    n_lists : int
+        The number of clusters (inverted lists).
+    n_iter : int, optional
+        The number of refinement iterations, by default 20.
+    seed : int, optional
+        Seed for the initial centroid sampling, by default 42.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        The centroids and the cluster assigned to each row.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for list_id in range(n_lists):
+            members = vectors[assignments == list_id]
+            if len(members):
+                centroids[list_id] = members.sum(axis=0)
+        centroids = _normalize(centroids)
+    assignments = np.argmax(vectors @ centroids.T, axis=1)
+    return centroids.astype(np.float32), assignments
+
+
+def _write_blob(directory: Path, name: str, items: List[bytes]) -> None:
+    """Write variable-length records as one contiguous blob plus offsets."""
+    offsets = np.zeros(len(items) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(item) for item in items])
+    (directory / f"{name}.bin").write_bytes(b"".join(items))
+    np.save(directory / f"{name}_offsets.npy", offsets)
+
+
+def _read_blob(directory: Path, name: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Memory-map a blob written by `_write_blob`."""
+    offsets = np.load(directory / f"{name}_offsets.npy", mmap_mode="r")
+    path = directory / f"{name}.bin"
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8), offsets
+    return np.memmap(path, dtype=np.uint8, mode="r"), offsets
+
+
+@contextmanager
+def file_lock(path: Path):
+    """Hold an exclusive lock on `path`, shared by every process of the host."""
+    fd = os.open(path, os.O_CREAT | os.O_RDWR)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _swap_link(link: Path, target: str) -> None:
+    """Atomically point the symlink `link` at `target`."""
+    staging = link.with_name(f"{link.name}.{os.getpid()}.tmp")
+    staging.unlink(missing_ok=True)
+    os.symlink(target, staging)
+    os.replace(staging, link)
+
+
+def _publish(path: Path, version: Path) -> None:
+    """
+    Make a freshly written index version the one served at `path`.
+
+    `path` is a symlink to the current version directory and is swapped with
+    `os.replace`, so readers open either the old or the new index, never a
+    partially written one. The version it replaces is kept, since workers may
+    still be opening it, and the one before that is removed.
+
+    Parameters
+    ----------
+    path : Path
+        Path the index is served from.
+    version : Path
+        Sibling directory holding the complete new index.
+    """
+    previous = path.with_name(f".{path.name}.previous")
+    with file_lock(path.with_name(f".{path.name}.lock")):
+        if path.exists() and not path.is_symlink():
+            # Index written in place, before versioned directories were used.
+            legacy = path.with_name(f".{path.name}.legacy")
+            path.rename(legacy)
+            os.symlink(legacy.name, path)
+
+        stale = previous.resolve() if previous.is_symlink() else None
+        if path.is_symlink():
+            _swap_link(previous, os.readlink(path))
+        _swap_link(path, version.name)
+
+        if stale is not None and stale.is_dir():
+            shutil.rmtree(stale, ignore_errors=True)
+
+
+class CompactVectorStore(VectorStore):
+    """
+    Read-only, in-process vector index backed by memory-mapped NumPy arrays.
+
+    Embeddings are stored unit-normalized as float16, or as int8 with one
+    scale factor per row, which makes the index 2-4x smaller than the float32
+    vectors kept by Chroma. Page contents and metadata live in two byte blobs
+    addressed by offset arrays, so only the rows that are returned are ever
+    decoded. Since every file is opened with `mmap_mode="r"`, all uvicorn
+    workers on the same host share a single copy through the page cache.
+
+    Search is an exact vectorized scan by default. When the index was built
+    with `n_lists > 0` the rows are grouped by k-means cluster (IVF) and only
+    the `n_probe` closest lists are scanned.
+
+    Attributes:
+        directory (Path): Directory holding the index files.
+        embedding (Embeddings): Function used to embed the queries.
+        n_probe (int): Number of inverted lists scanned per query.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        embedding: Embeddings,
+        n_probe: int = 4,
+    ):
+        # Resolved once so every file comes from the same index version.
+        self.directory = Path(directory).resolve()
+        self.embedding = embedding
+        self.n_probe = n_probe
+
+        manifest = json.loads((self.directory / MANIFEST_FILE).read_text())
+        self.dtype = manifest["dtype"]
+        self.vectors = np.load(self.directory / "vectors.npy", mmap_mode="r")
+        self.scales = np.load(self.directory / "scales.npy", mmap_mode="r")
+        self.centroids = np.load(self.directory / "centroids.npy", mmap_mode="r")
+        self.list_offsets = np.load(self.directory / "list_offsets.npy", mmap_mode="r")
+        self._texts, self._text_offsets = _read_blob(self.directory, "texts")
+        self._metadatas, self._metadata_offsets = _read_blob(
+            self.directory, "metadatas"
+        )
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self.embedding
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @classmethod
+    def build(
+        cls,
+        directory: str,
+        texts: List[str],
+        embeddings: List[List[float]],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        dtype: str = "float16",
+        n_lists: int = 0,
+        **kwargs: Any,
+    ) -> "CompactVectorStore":
+        """
+        Write precomputed embeddings to disk and open the resulting index.
+
+        The files are written to a new sibling directory which then replaces
+        the served index atomically, so the index can be rebuilt while other
+        processes have it memory-mapped.
+
+        Parameters
+        ----------
+        directory : str
+            Directory where the index files will be written.
+        texts : List[str]
+            Page contents, one per embedding.
+        embeddings : List[List[float]]
+            The embedding of each text.
+        embedding : Embeddings
+            Function used to embed the queries at search time.
+        metadatas : List[dict], optional
+            Metadata of each text, by default empty dictionaries.
+        dtype : str, optional
+            Storage type, "float16" or "int8", by default "float16".
+        n_lists : int, optional
+            Number of IVF lists, 0 for exact search, by default 0.
+
+        Returns
+        -------
+        CompactVectorStore
+            The memory-mapped index.
+
+        Raises
+        ------
+        ValueError
+            When `dtype` is not supported or there is nothing to index.
+        """
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"dtype must be one of {SUPPORTED_DTYPES}, got {dtype}")
+        if len(texts) == 0:
+            raise ValueError(f"No texts to index in {directory}.")
+        if metadatas is None:
+            metadatas = [{} for _ in texts]
+
+        path = Path(directory)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        version = Path(tempfile.mkdtemp(prefix=f".{path.name}.", dir=path.parent))
+        version.chmod(0o755)
+
+        vectors = _normalize(np.asarray(embeddings, dtype=np.float32))
+        n_lists = min(n_lists, len(vectors))
+        if n_lists > 1:
+            centroids, assignments = _kmeans(vectors, n_lists)
+            order = np.argsort(assignments, kind="stable")
+            counts = np.bincount(assignments, minlength=n_lists)
+        else:
+            centroids = np.zeros((0, vectors.shape[1]), dtype=np.float32)
+            order = np.arange(len(vectors))
+            counts = np.array([len(vectors)])
+        list_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(counts)
+
+        quantized, scales = _quantize(vectors[order], dtype)
+        np.save(version / "vectors.npy", quantized)
+        np.save(version / "scales.npy", scales)
+        np.save(version / "centroids.npy", centroids)
+        np.save(version / "list_offsets.npy", list_offsets)
+        _write_blob(version, "texts", [texts[i].encode("utf-8") for i in order])
+        _write_blob(
+            version,
+            "metadatas",
+            [
+                json.dumps(metadatas[i], separators=(",", ":")).encode("utf-8")
+                for i in order
+            ],
+        )
+        manifest = {
+            "dtype": dtype,
+            "dim": int(vectors.shape[1]),
+            "count": int(len(vectors)),
+            "n_lists": int(len(centroids)),
+        }
+        (version / MANIFEST_FILE).write_text(json.dumps(manifest))
+        _publish(path, version)
+        logging.info(
+            f"Índice compacto salvo em {directory}: {len(vectors)} vetores {dtype}."
+        )
+        return cls(directory, embedding, **kwargs)
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: List[str],
+        embedding: Embeddings,
+        metadatas: Optional[List[dict]] = None,
+        persist_directory: str = "data/03_primary/compact_index",
+        **kwargs: Any,
+    ) -> "CompactVectorStore":
+        texts = list(texts)
+        embeddings = embedding.embed_documents(texts)
+        return cls.build(
+            persist_directory, texts, embeddings, embedding, metadatas, **kwargs
+        )
+
+    @classmethod
+    def from_chroma(
+        cls,
+        docsearch: Chroma,
+        persist_directory: str,
+        **kwargs: Any,
+    ) -> "CompactVectorStore":
+        """
+        Export an existing Chroma collection without re-embedding it.
+
+        Parameters
+        ----------
+        docsearch : Chroma
+            The populated Chroma store.
+        persist_directory : str
+            Directory where the compact index will be written.
+
+        Returns
+        -------
+        CompactVectorStore
+            The memory-mapped index.
+        """
+        data = docsearch.get(include=["embeddings", "documents", "metadatas"])
+        return cls.build(
+            persist_directory,
+            data["documents"],
+            data["embeddings"],
+            docsearch.embeddings,
+            data["metadatas"],
+            **kwargs,
+        )
+
+    def add_texts(
+        self,
+        texts: Iterable[str],
+        metadatas: Optional[List[dict]] = None,
+        **kwargs: Any,
+    ) -> List[str]:
+        raise NotImplementedError(
+            "CompactVectorStore é somente leitura; reconstrua o índice com "
+            "CompactVectorStore.build ou from_chroma."
+        )
+
+    def _select_relevance_score_fn(self) -> Callable[[float], float]:
+        return self._cosine_relevance_score_fn
+
+    def _document(self, row: int) -> LangchainDocument:
+        start, end = self._text_offsets[row], self._text_offsets[row + 1]
+        text = bytes(self._texts[start:end])
+        start, end = self._metadata_offsets[row], self._metadata_offsets[row + 1]
+        metadata = bytes(self._metadatas[start:end])
+        return LangchainDocument(
+            page_content=text.decode("utf-8"), metadata=json.loads(metadata)
+        )
+
+    def _candidate_ranges(self, query: np.ndarray) -> List[Tuple[int, int]]:
+        if len(self.centroids) == 0:
+            return [(0, len(self.vectors))]
+        n_probe = min(self.n_probe, len(self.centroids))
+        closest = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        return [
+            (int(self.list_offsets[i]), int(self.list_offsets[i + 1]))
+            for i in sorted(closest)
+        ]
+
+    def _scan(self, query: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Return the top-k rows and cosine similarities for a normalized query."""
+        rows, scores = [], []
+        for start, end in self._candidate_ranges(query):
+            for block in range(start, end, SEARCH_BLOCK_ROWS):
+                stop = min(block + SEARCH_BLOCK_ROWS, end)
+                block_scores = self.vectors[block:stop].astype(np.float32) @ query
+                if self.dtype == "int8":
+                    block_scores *= self.scales[block:stop]
+                rows.append(np.arange(block, stop))
+                scores.append(block_scores)
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        rows, scores = np.concatenate(rows), np.concatenate(scores)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return rows[top], scores[top]
+
+    def similarity_search_by_vector_with_score(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[LangchainDocument, float]]:
+        """
+        Search the index with an embedded query.
+
+        Parameters
+        ----------
+        embedding : List[float]
+            The query embedding.
+        k : int, optional
+            Number of documents to return, by default 4.
+
+        Returns
+        -------
+        List[Tuple[LangchainDocument, float]]
+            Documents and their cosine distance, closest first.
+        """
+        query = _normalize(np.asarray(embedding, dtype=np.float32))
+        rows, scores = self._scan(query, k)
+        return [
+            (self._document(int(row)), max(0.0, float(1.0 - score)))
+            for row, score in zip(rows, scores)
+        ]
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[Tuple[LangchainDocument, float]]:
+        return self.similarity_search_by_vector_with_score(
+            self.embedding.embed_query(query), k
+        )
+
+    def similarity_search_by_vector(
+        self, embedding: List[float], k: int = 4, **kwargs: Any
+    ) -> List[LangchainDocument]:
+        return [
+            doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)
+        ]
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: Any
+    ) -> List[LangchainDocument]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
@@ -1,16 +1,34 @@
+import asyncio
+import logging
+import time
+
 import chainlit as cl
 import httpx
 
 API_URL = "http://localhost:8000/query"
 
+# One keep-alive connection pool shared by every Chainlit session.
+client = httpx.AsyncClient(
+    timeout=20.0,
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+)
+
+
+@cl.on_chat_start
+async def start():
+    # Only one request per session reaches the API; further messages wait here.
+    cl.user_session.set("request_lock", asyncio.Lock())
+
 
 @cl.on_message
 async def main(message: cl.Message) -> cl.Message:
     question = message.content
+    session_id = cl.user_session.get("id")
 
-    payload = {"question": question}
+    payload = {"question": question, "session_id": session_id}
 
-    async with httpx.AsyncClient(timeout=20.0) as client:
+    async with cl.user_session.get("request_lock"):
+        start_time = time.perf_counter()
         try:
             response = await client.post(API_URL, json=payload)
             response.raise_for_status()
@@ -20,5 +38,7 @@ async def main(message: cl.Message) -> cl.Message:
             response_message = f"Ocorreu um erro ao consultar a API: {str(e)}"
         except httpx.RequestError as e:
             response_message = f"Erro na requisição: {str(e)}"
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+        logging.info(f"Sessão {session_id}: resposta da API em {elapsed_ms:.0f} ms")
 
     await cl.Message(content=response_message).send()